@@ -168,7 +168,7 @@ corner_hashOP = np.array([1, 2, 10]) # 3d
 edge_hashOP = np.array([1, 10]) # 2d
 
 # [max hash number, [cubelet position, face position]] z y x
-corner_pieceInds = np.zeros([62, 2], dtype=np.int)
+corner_pieceInds = np.zeros([62, 2], dtype=int)
 corner_pieceInds[50] = [0, 0]; corner_pieceInds[54] = [0, 1]; corner_pieceInds[13] = [0, 2]
 corner_pieceInds[28] = [1, 0]; corner_pieceInds[ 8] = [1, 1]; corner_pieceInds[42] = [1, 2]
 corner_pieceInds[14] = [2, 0]; corner_pieceInds[ 5] = [2, 1]; corner_pieceInds[12] = [2, 2]
@@ -179,7 +179,7 @@ corner_pieceInds[47] = [5, 0]; corner_pieceInds[30] = [5, 1]; corner_pieceInds[4
 corner_pieceInds[17] = [6, 0]; corner_pieceInds[35] = [6, 1]; corner_pieceInds[18] = [6, 2]
 corner_pieceInds[23] = [7, 0]; corner_pieceInds[56] = [7, 1]; corner_pieceInds[21] = [7, 2]
 
-edge_pieceInds = np.zeros([55, 2], dtype=np.int)
+edge_pieceInds = np.zeros([55, 2], dtype=int)
 # 40과 43이 중복이다 왜??
 edge_pieceInds[50] = [0, 0]; edge_pieceInds[ 5] = [0, 1]
 edge_pieceInds[40] = [1, 0]; edge_pieceInds[ 4] = [1, 1]
@@ -222,9 +222,10 @@ def doMove_3(s, move):
     return s[moveDefs[move]]
 
 def getOP_3(s):
-    corner_op = corner_pieceInds[np.dot(s[corner_pieceDefs], corner_hashOP)]
-    edge_op = edge_pieceInds[np.dot(s[edge_pieceDefs], edge_hashOP)]
-    return np.concatenate((corner_op, edge_op))
+    # s: ..., 54, leading dimensions are batch of cubes
+    corner_op = corner_pieceInds[np.dot(s[..., corner_pieceDefs], corner_hashOP)]
+    edge_op = edge_pieceInds[np.dot(s[..., edge_pieceDefs], edge_hashOP)]
+    return np.concatenate((corner_op, edge_op), axis=-2)
 
 def isSolved_3(s):
   for i in range(6):
@@ -233,14 +234,10 @@ def isSolved_3(s):
   return True
 
 def pos_to_state_3(pos):
-    # pos: 20, 2 -> [cube name, [cubelet position, face position]]
-    # state: 20, 24
-    state = np.zeros([20, 24], dtype=np.int)
-    for position, pos_element in enumerate(pos):
-        if position < 8:
-            state_value = pos_element[0] * 3 + pos_element[1]
-        else:
-            state_value = pos_element[0] * 2 + pos_element[1]
-    
-        state[position][state_value] = 1.0
+    # pos: ..., 20, 2 -> [cube name, [cubelet position, face position]]
+    # state: ..., 20, 24
+    orientation_count = np.array([3] * 8 + [2] * 12) # corner cubelets have 3 faces, edge cubelets have 2 faces
+    state_value = pos[..., 0] * orientation_count + pos[..., 1]
+    state = np.zeros(pos.shape[:-1] + (24,), dtype=np.uint8)
+    np.put_along_axis(state, state_value[..., None], 1, axis=-1)
     return state
\ No newline at end of file
@@ -29,6 +29,7 @@ class CubeEnv(gym.Env):
         self.show_cube = False
         self.state_dim, self.action_dim = get_env_config(cube_size)
         self.init_state()
+        self.move_table = self.get_move_table()
     
     def init_state(self):
         """
@@ -110,6 +111,25 @@ class CubeEnv(gym.Env):
             self.fig.axes[3].rotate_face(face, degree, layer = 0)
         return self.cube, reward, done, {}
 
+    def get_snapshot(self):
+        """
+        Return snapshot of current cube which can be restored with restore_snapshot
+        step never modifies cube arrays in place, so no copy is needed
+
+        Returns:
+            Tuple of simulation state and state
+        """
+        return self.sim_cube, self.cube
+
+    def restore_snapshot(self, snapshot):
+        """
+        Restore cube from snapshot, rendered cube is not updated
+
+        Args:
+            snapshot: Snapshot from get_snapshot
+        """
+        self.sim_cube, self.cube = snapshot
+
     def render(self, mode=None):
         """
         Render the environment to the screen
@@ -151,6 +171,53 @@ class CubeEnv(gym.Env):
             raise NotImplementedError
         return state
     
+    def sim_states_to_states(self, sim_states):
+        """
+        Return our states from batch of simulation states
+
+        Args:
+            sim_states: Numpy array of simulation states of shape [batch size, number of stickers]
+
+        Returns:
+            Numpy array of our states of shape [batch size, *state_dim]
+        """
+        if self.cube_size == 2:
+            states = np.array([self.sim_state_to_state(sim_state) for sim_state in sim_states])
+        elif self.cube_size == 3:
+            states = pos_to_state_3(getOP_3(sim_states))
+        else:
+            raise NotImplementedError
+        return states
+
+    def get_move_table(self):
+        """
+        Return sticker permutation of each action, moving simulation state s with action a is s[move_table[a]]
+
+        Returns:
+            Numpy array of shape [action_dim, number of stickers]
+        """
+        if self.cube_size == 2:
+            move = doMove
+        elif self.cube_size == 3:
+            move = doMove_3
+        else:
+            raise NotImplementedError
+        sticker_idx = np.arange(len(self.sim_cube)) # moving sticker indices gives permutation itself
+        return np.array([move(sticker_idx, sim_action) for sim_action in self.action_to_sim_action[self.cube_size]])
+
+    def is_solved_batch(self, sim_states):
+        """
+        Return whether each simulation state is solved, every face has stickers of single color
+
+        Args:
+            sim_states: Numpy array of simulation states of shape [..., number of stickers]
+
+        Returns:
+            Boolean numpy array of shape [...]
+        """
+        faces = sim_states.reshape(sim_states.shape[:-1] + (6, -1))
+        return (faces == faces[..., :1]).all(axis=(-2, -1))
+
     def state_to_sim_state(self, state):
         """
         Return simulation state from our state
@@ -177,6 +244,7 @@ class CubeEnv(gym.Env):
     def get_random_samples(self, replay_buffer, model, sample_scramble_count, sample_cube_count, temperature):
         """
         Add samples to replay buffer which contain (state, target value, target policy, scramble count, error)  for training
+        All cubes are scrambled together, a scramble step of every cube is one gather with move table
         
         Args:
             replay_buffer: Replay buffer to save samples
@@ -184,72 +252,62 @@ class CubeEnv(gym.Env):
             sample_scramble_count: Number of scramble cubes randomly
             sample_cube_count: Number of cube samples
         """
-        for sample_cube_idx in range(1, sample_cube_count+1):
-            self.init_state()
-            action_sequence = np.random.randint(self.action_dim, size=sample_scramble_count)
-            for scramble_idx, action in enumerate(action_sequence):
-                state, _, _, _ = self.step(action)
-                target_value, target_policy, error = self.get_target_value(model, scramble_idx+1, temperature)
-                sample = {'state':state, 'target_value':target_value, 'target_policy':target_policy, 'scramble_count':scramble_idx+1, 'error':error}
-                replay_buffer.append(sample)
+        self.init_state()
+        action_sequences = np.random.randint(self.action_dim, size=(sample_cube_count, sample_scramble_count))
+        sim_cubes = np.tile(self.sim_cube, (sample_cube_count, 1))
+        cube_idx = np.arange(sample_cube_count)[:, None]
+
+        states = np.zeros((sample_cube_count, sample_scramble_count, *self.state_dim), dtype=np.uint8)
+        target_values = np.zeros((sample_cube_count, sample_scramble_count), dtype=np.float32)
+        target_policies = np.zeros((sample_cube_count, sample_scramble_count), dtype=np.int64)
+        errors = np.zeros((sample_cube_count, sample_scramble_count), dtype=np.float64)
+        for scramble_idx in range(sample_scramble_count):
+            sim_cubes = sim_cubes[cube_idx, self.move_table[action_sequences[:, scramble_idx]]]
+            states[:, scramble_idx] = self.sim_states_to_states(sim_cubes)
+            target_values[:, scramble_idx], target_policies[:, scramble_idx], errors[:, scramble_idx] = \
+                self.get_target_values(model, states[:, scramble_idx], sim_cubes, scramble_idx+1, temperature)
+
+        # samples of each cube are stored in scramble order
+        scramble_counts = np.tile(np.arange(1, sample_scramble_count+1), sample_cube_count)
+        replay_buffer.extend(states.reshape(-1, *self.state_dim), target_values.reshape(-1), target_policies.reshape(-1),
+                             scramble_counts, errors.reshape(-1))
 
-    def get_target_value(self, model, scramble_count, temperature):
+    def get_target_values(self, model, states, sim_cubes, scramble_count, temperature):
         """
-        Return target value and target policy
+        Return target values and target policies of states with a single forward pass of model
 
         Args:
-            state_list: List of states you want to get target valu and target policy
             model: Current deep cube model
-            scramble_count: Scramble count of sample 
+            states: Numpy array of states you want to get target value and target policy
+            sim_cubes: Numpy array of simulation states corresponding states, shape [number of states, number of stickers]
+            scramble_count: Scramble count of states
+            temperature: Constant of scramble count weight
 
         Returns:
-            target_value
-            target_policy
-            error: Difference between state value and target value
-        """
-        reward_list = []
-        next_state_list = []
-        for action in range(self.action_dim):
-            if self.cube_size == 2:
-                sim_action = self.action_to_sim_action[self.cube_size][action]
-                next_sim_cube = doMove(self.sim_cube, sim_action)
-                next_state = self.sim_state_to_state(next_sim_cube)
-                if isSolved(next_sim_cube):
-                    reward = 1.0
-                    target_value, target_policy = 1.0, action
-                    break
-                else:
-                    reward = -1.0
-                next_state_list.append(next_state)
-                reward_list.append(reward)
-            elif self.cube_size == 3:
-                sim_action = self.action_to_sim_action[self.cube_size][action]
-                next_sim_cube = doMove_3(self.sim_cube, sim_action)
-                next_state = self.sim_state_to_state(next_sim_cube)
-                if isSolved_3(next_sim_cube):
-                    reward = 1.0
-                    target_value, target_policy = 1.0, action
-                    break
-                else:
-                    reward = -1.0
-                next_state_list.append(next_state)
-                reward_list.append(reward)
-            else:
-                raise NotImplementedError
-        if reward != 1.0:
-            next_state_tensor = torch.tensor(np.array(next_state_list), device=self.device).float() # action_dim, state_dim[0], state_dim[1]
-            reward_tensor = torch.tensor(reward_list, device = self.device) # action_dim
-            with torch.no_grad():
-                next_value, _ = model(next_state_tensor)
-                value = next_value.squeeze(dim=-1).detach() + reward_tensor
-            target_value, target_policy = torch.max(value, -1, keepdim=True)
-            target_value, target_policy = target_value.item(), target_policy.item()
-        weight = scramble_count ** (-1*temperature)
+            target_values: Numpy array of target values
+            target_policies: Numpy array of target policies
+            errors: Numpy array of differences between state value and target value
+        """
+        num_states = len(states)
+        next_sim_cubes = sim_cubes[:, self.move_table] # [number of states, action_dim, number of stickers]
+        next_states = self.sim_states_to_states(next_sim_cubes.reshape(num_states*self.action_dim, -1))
+
+        # next states of all states and states themselves are evaluated together
+        state_tensor = torch.tensor(np.concatenate((next_states, states)), device=self.device).float()
         with torch.no_grad():
-            state_tensor = torch.tensor(self.cube, device=self.device).float()
             value, _ = model(state_tensor)
-            error = abs(value.detach().item() - target_value) * weight
-        return target_value, target_policy, error
+            value = value.squeeze(dim=-1).detach()
+        next_value = value[:-num_states].view(num_states, self.action_dim) - 1.0 # reward of unsolved state is -1.0
+        state_value = value[-num_states:]
+        target_value, target_policy = torch.max(next_value, -1)
+
+        solved = torch.as_tensor(self.is_solved_batch(next_sim_cubes), device=self.device)
+        has_solved = solved.any(dim=-1)
+        target_value = torch.where(has_solved, torch.ones_like(target_value), target_value)
+        target_policy = torch.where(has_solved, solved.int().argmax(dim=-1), target_policy) # first action to solve cube
+
+        error = (state_value - target_value).abs() * scramble_count ** (-1*temperature)
+        return target_value.cpu().numpy(), target_policy.cpu().numpy(), error.cpu().numpy()
     
     def save_video(self, cube_size, scramble_count, sample_cube_count, video_path='./video'):
         """
@@ -1,6 +1,5 @@
 import math
 import random
-import copy
 from collections import deque
 
 import numpy as np
@@ -8,6 +7,27 @@ import numpy as np
 from utils import get_env_config
 
 EPS = 1e-8
+INITIAL_NODE_CAPACITY = 1024
+
+def puct_select(policy, value, number_of_visits, virtual_loss, sqrt_total_visits, exploration_constant):
+    """
+    Select action of node which maximizes U + W - L
+    Args:
+        policy : prior policy P of node, float32 array size (action_dim,)
+        value : value W of each action, float32 array size (action_dim,)
+        number_of_visits : number of visit N of each action, int64 array size (action_dim,)
+        virtual_loss : virtual loss L of each action, float32 array size (action_dim,)
+        sqrt_total_visits : square root of number of visit of node
+        exploration_constant : constant c of exploration term U
+    Returns:
+        index of most promising action
+    """
+    u_plus_w_a = sqrt_total_visits / (1.0 + number_of_visits)
+    u_plus_w_a *= policy
+    u_plus_w_a *= exploration_constant
+    u_plus_w_a += value
+    u_plus_w_a -= virtual_loss
+    return int(u_plus_w_a.argmax())
 
 class MCTS():
     """
@@ -17,35 +37,151 @@ class MCTS():
     def __init__(self, model, cfg):
         self.model = model
 
-        self.children_and_data = dict()
-
-        self.ch_i = 0  # list of next states
-        self.p_i = 1  #policy P
-        self.s_i = 2  #value W
-        self.n_of_v_i = 3  #number of visit N
-        self.v_l_i = 4  #virtual loss L
-        self.done = 5  # 
-
-
         self.loss_constant = cfg['mcts']['virtual_loss_const']
         self.exploration_constant = cfg['mcts']['cpuct']
         self.value_min = cfg['mcts']['value_min']
+        self.leaf_batch_size = cfg['mcts']['leaf_batch_size']
         self.cube_size = cfg['test']['cube_size']
         _, self.action_dim = get_env_config(self.cube_size)
 
-    def train(self, state, env):
-        simulation_env = copy.deepcopy(env)
+        # Nodes are interned to integer ids, data of node id is row id of node arrays
+        self.state_to_id = dict()
+        self.num_nodes = 0
+        self.allocate(INITIAL_NODE_CAPACITY)
 
+    def allocate(self, capacity):
+        """
+        Allocate node arrays which can store capacity nodes, keeping data of existing nodes
+        Args:
+            capacity : number of nodes
+        """
+        node_arrays = {
+            'children': np.full((capacity, self.action_dim), -1, dtype=np.int64),  # id of next states
+            'policy': np.zeros((capacity, self.action_dim), dtype=np.float32),  # policy P
+            'value': np.full((capacity, self.action_dim), self.value_min, dtype=np.float32),  # value W
+            'number_of_visits': np.zeros((capacity, self.action_dim), dtype=np.int64),  # number of visit N
+            'virtual_loss': np.zeros((capacity, self.action_dim), dtype=np.float32),  # virtual loss L
+            'is_solved': np.zeros((capacity, self.action_dim), dtype=bool),  # whether next state is solved
+            'expanded': np.zeros(capacity, dtype=bool),
+            'total_visits': np.zeros(capacity, dtype=np.int64),  # number of visit of node
+            'sqrt_total_visits': np.zeros(capacity, dtype=np.float64),
+        }
+        for name, node_array in node_arrays.items():
+            if self.num_nodes:
+                old_node_array = getattr(self, name)
+                node_array[:len(old_node_array)] = old_node_array
+            setattr(self, name, node_array)
+
+    def get_node_id(self, state_key):
+        """
+        Return id of node, new id is given to state seen first time
+        Args:
+            state_key : key of state from _key
+        Returns:
+            id of node
+        """
+        node_id = self.state_to_id.setdefault(state_key, self.num_nodes)
+        if node_id == self.num_nodes:
+            self.num_nodes += 1
+            if self.num_nodes > len(self.expanded):
+                self.allocate(2 * len(self.expanded))
+        return node_id
+
+    @staticmethod
+    def _key(state):
+        """
+        Return hashable key of state used to index the tree
+        Args:
+            state : numpy array which represents state  (7,21)
+        Returns:
+            Raw bytes of state as contiguous uint8 array
+        """
+        return np.ascontiguousarray(state, dtype=np.uint8).tobytes()
 
-        path_to_leaf, actions_to_leaf, leaf = self.traverse(state, simulation_env)
-        reward = self.expand(leaf, simulation_env)
-        self.backpropagate(path_to_leaf, actions_to_leaf, reward)
+    def train(self, state, env):
+        """
+        This function performs one round of search from root state.
+        With leaf_batch_size > 1, root is expanded first and several traverses run
+        under virtual loss, then their leaves are evaluated with a single batched forward pass.
+        Args:
+            state : numpy array which represents state  (7,21)
+            env : deepcube gym environment
+        Returns:
+            list of actions from root node to solved state if found, else None
+        """
+        # env is stepped in place during search and restored to root snapshot afterwards
+        env = env.unwrapped
+        root_snapshot = env.get_snapshot()
+        if self.leaf_batch_size == 1:
+            path_to_leaf, actions_to_leaf, leaf, leaf_id = self.traverse(state, env)
+            reward = self.expand(leaf, leaf_id, env)
+            env.restore_snapshot(root_snapshot)
+            self.backpropagate(path_to_leaf, actions_to_leaf, reward)
+            return self.get_solved_actions(actions_to_leaf, leaf_id)
+
+        root_id = self.get_node_id(self._key(state))
+        if not self.expanded[root_id]: # otherwise every traverse of the batch stops at unexpanded root
+            self.expand(state, root_id, env)
+            solved_actions = self.get_solved_actions([], root_id)
+            if solved_actions is not None:
+                return solved_actions
+
+        searches = []
+        for _ in range(self.leaf_batch_size):
+            path_to_leaf, actions_to_leaf, leaf, leaf_id = self.traverse(state, env)
+            searches.append((path_to_leaf, actions_to_leaf, leaf, leaf_id, env.get_snapshot()))
+            env.restore_snapshot(root_snapshot)
+
+        leaf_states = np.stack([leaf for _, _, leaf, _, _ in searches])
+        values, policies = self.model.predict_batch(leaf_states)
+
+        for (path_to_leaf, actions_to_leaf, _, leaf_id, leaf_snapshot), value, policy in zip(searches, values, policies):
+            if not self.expanded[leaf_id]: # same leaf can be reached twice in a batch
+                env.restore_snapshot(leaf_snapshot)
+                self.add_node(leaf_id, env, policy)
+            self.backpropagate(path_to_leaf, actions_to_leaf, value)
+        env.restore_snapshot(root_snapshot)
+
+        for _, actions_to_leaf, _, leaf_id, _ in searches:
+            solved_actions = self.get_solved_actions(actions_to_leaf, leaf_id)
+            if solved_actions is not None:
+                return solved_actions
 
+        return None
 
-        for i in range(len(self.children_and_data[np.array2string(leaf)][self.ch_i])):
-            if self.children_and_data[np.array2string(leaf)][self.done][i]:
-                actions_to_leaf.append(i)
-                return actions_to_leaf
+    def get_action_prob(self, state, temp=1):
+        """
+        This function returns probability of each action at state, proportional to N^(1/temp)
+        Args:
+            state : numpy array which represents state  (7,21)
+            temp : temperature, 0 gives probability only to most visited actions
+        Returns:
+            probs : float32 numpy array size (action_dim,)
+        """
+        node_id = self.state_to_id.get(self._key(state))
+        if node_id is None or self.total_visits[node_id] == 0: # not searched yet
+            return np.full(self.action_dim, 1.0 / self.action_dim, dtype=np.float32)
+
+        counts = self.number_of_visits[node_id]
+        if temp == 0:
+            probs = (counts == counts.max()).astype(np.float32)
+        else:
+            probs = np.power(counts, 1.0 / temp, dtype=np.float32)
+        probs /= probs.sum()
+        return probs
+
+    def get_solved_actions(self, actions_to_leaf, leaf_id):
+        """
+        This function checks whether a child of expanded leaf node is solved state.
+        Args:
+            actions_to_leaf : list of actions(0-5) from root node to leaf node
+            leaf_id : id of leaf node
+        Returns:
+            list of actions from root node to solved state if found, else None
+        """
+        solved_actions = np.flatnonzero(self.is_solved[leaf_id])
+        if len(solved_actions):
+            return actions_to_leaf + [int(solved_actions[0])]
 
         return None
 
@@ -54,104 +190,104 @@ class MCTS():
         This function performs one traverse until it finds leaf node.
         Args:
             state : numpy array which represents state  (7,21)
+            env : deepcube gym environment at state, left at leaf node
         Returns:
-            path_to_leaf : list of states(string) from root node to leaf node(exclude leaf node)
+            path_to_leaf : list of node ids from root node to leaf node(exclude leaf node)
             actions_to_leaf : list of actions(0-5) from root node to leaf node
-            current : state of leaf node
+            current_arr : state of leaf node
+            current : id of leaf node
         """
 
         path_to_leaf = []
         actions_to_leaf = []
         current_arr = state
-        current = np.array2string(state)
+        current = self.get_node_id(self._key(state))
         while True:
-            if current not in self.children_and_data or not self.children_and_data[current][self.ch_i]:
-                return path_to_leaf, actions_to_leaf, current_arr
-            else:
-                if sum(self.children_and_data[current][self.n_of_v_i]) == 0: #?
-                    action_index = random.randint(0, self.action_dim - 1)
+            if not self.expanded[current]:
+                return path_to_leaf, actions_to_leaf, current_arr, current
+
+            if self.total_visits[current] == 0: # no action visited yet
+                # actions taken by pending traverses of the batch carry virtual loss
+                free_actions = np.flatnonzero(self.virtual_loss[current] == 0)
+                if len(free_actions):
+                    action_index = int(free_actions[random.randint(0, len(free_actions) - 1)])
                 else:
                     action_index = self.get_most_promising_action_index(current)
+            else:
+                action_index = self.get_most_promising_action_index(current)
 
-                path_to_leaf.append(current)
-                actions_to_leaf.append(action_index)
-                self.children_and_data[current][self.v_l_i][action_index] += self.loss_constant
+            path_to_leaf.append(current)
+            actions_to_leaf.append(action_index)
+            self.virtual_loss[current, action_index] += self.loss_constant
 
-                current_arr, _, _, _ = env.step(action_index)
-                current = self.children_and_data[current][self.ch_i][action_index]
+            current_arr, _, _, _ = env.step(action_index)
+            current = int(self.children[current, action_index])
 
-    def expand(self, state, env):
+    def expand(self, state, node_id, env):
         """
         This function performs expansion of node from leaf node.
         Args:
             state : state of leaf node, numpy array size (7,21)
+            node_id : id of leaf node
             env : deepcube gym environment
         Returns:
             value : state value of leaf node
         """
         value, policy = self.model.predict(state)
+        self.add_node(node_id, env, policy)
 
-        next_states = []
+        return value
+
+    def add_node(self, node_id, env, policy):
+        """
+        This function adds leaf node and its children to the tree.
+        Args:
+            node_id : id of leaf node
+            env : deepcube gym environment
+            policy : prior policy of leaf node, float32 array size (action_dim,)
+        """
+        child_ids = []
         is_solved = []
-        original_env = copy.deepcopy(env)
+        leaf_snapshot = env.get_snapshot()
         for i in range(self.action_dim):
             next_s, _, done, _ = env.step(i)
-            next_states.append(np.array2string(next_s))
+            child_ids.append(self.get_node_id(self._key(next_s)))
             is_solved.append(done)
-            env = copy.deepcopy(original_env)
-            
-
-        self.children_and_data[np.array2string(state)] = (
-            next_states,
-            policy,
-            [self.value_min] * self.action_dim,
-            [0] * self.action_dim,
-            [0] * self.action_dim,
-            is_solved)
-        
+            env.restore_snapshot(leaf_snapshot)
 
-        return value
+        # node arrays may be reallocated while interning children
+        self.children[node_id] = child_ids
+        self.is_solved[node_id] = is_solved
+        self.policy[node_id] = policy
+        self.expanded[node_id] = True
 
     def backpropagate(self, path_to_leaf, actions_to_leaf, reward):
         """
         This function performs backpropagation from leaf to root node.
         Args:
-            path_to_leaf : list of states, path of searched nodes
+            path_to_leaf : list of node ids, path of searched nodes
             actions_to_leaf : list of actions, path of searched nodes
             reward : state value of leaf node
         """
-        for state_to_leaf, action_to_leaf in zip(list(reversed(path_to_leaf)), list(reversed(actions_to_leaf))):  # 역순으로 가야하는거 아닌가?
-            self.children_and_data[state_to_leaf][self.s_i][action_to_leaf] = max(
-                self.children_and_data[state_to_leaf][self.s_i][action_to_leaf], reward)
-
-            self.children_and_data[state_to_leaf][self.v_l_i][action_to_leaf] -= 150
-
-            self.children_and_data[state_to_leaf][self.n_of_v_i][action_to_leaf] += 1
-            # print(self.children_and_data[state_to_leaf][self.s_i])
-
-    def get_most_promising_action_index(self, state):
+        for node_id, action_to_leaf in zip(reversed(path_to_leaf), reversed(actions_to_leaf)):
+            if reward > self.value[node_id, action_to_leaf]:
+                self.value[node_id, action_to_leaf] = reward
+            self.virtual_loss[node_id, action_to_leaf] -= self.loss_constant
+            self.number_of_visits[node_id, action_to_leaf] += 1
+            self.total_visits[node_id] += 1
+            self.sqrt_total_visits[node_id] = math.sqrt(self.total_visits[node_id])
+
+    def get_most_promising_action_index(self, node_id):
         """
         This function give action which is most promising according to paper during searching
         Args:
-            path_to_leaf : list of states, path of searched nodes
-            actions_to_leaf : list of actions, path of searched nodes
-            reward : state value of leaf node
+            node_id : id of node
         
         Return:
             index of most promising action
         """
-        state_all_actions_number_of_visits = sum(self.children_and_data[state][self.n_of_v_i])
-        u_plus_w_a = [0] * self.action_dim
-        for i in range(self.action_dim):
-            u_st_a = self.exploration_constant \
-                     * self.children_and_data[state][self.p_i][i] \
-                     * (math.sqrt(state_all_actions_number_of_visits)
-                        / (1 + self.children_and_data[state][self.n_of_v_i][i]))
-            u_plus_w_a[i] = u_st_a \
-                            + self.children_and_data[state][self.s_i][i] \
-                            - self.children_and_data[state][self.v_l_i][i]
-
-        return max(range(self.action_dim), key=u_plus_w_a.__getitem__)
+        return puct_select(self.policy[node_id], self.value[node_id], self.number_of_visits[node_id],
+                           self.virtual_loss[node_id], self.sqrt_total_visits[node_id], self.exploration_constant)
 
     """
     Leaving here as I wrote it for testing to make sure bfs works
@@ -171,38 +307,42 @@ class MCTS():
         to make sure bfs works
         self.children = dict()
         self.expand_levels(state, 0, 2)
+
+        Returns shortest list of actions in searched tree from state to solved state, None if not found
         """
 
-        visited = {state}
+        root = self.state_to_id.get(self._key(state))
+        if root is None:
+            return None
+
+        visited = {root}
         solved = None
         state_to_parent_and_index_from_parent = dict()
-        state_to_parent_and_index_from_parent[state] = (None, None)
+        state_to_parent_and_index_from_parent[root] = (None, None)
 
         queue = deque()
-        queue.append(state)
+        queue.append(root)
         while len(queue) != 0:
             current = queue.popleft()
-            if current.is_solved():
+            if not self.expanded[current]:  # in MCTS not all branches are visited
+                continue
+
+            solved_actions = np.flatnonzero(self.is_solved[current])
+            if len(solved_actions):
                 solved = current
                 break
 
-            if current not in self.children_and_data:  # in MCTS not all branches are visited
-                continue
-
-            i = 0
-            for current_child in self.children_and_data[current][self.ch_i]:
+            for i, current_child in enumerate(self.children[current].tolist()):
                 if current_child not in visited:
                     queue.append(current_child)
                     state_to_parent_and_index_from_parent[current_child] = (current, i)
                     visited.add(current_child)
 
-                i += 1
-
         if solved is None:
             return None
 
         current = solved
-        reversed_actions_to_leaf = []
+        reversed_actions_to_leaf = [int(solved_actions[0])]
         while True:
             pair = state_to_parent_and_index_from_parent[current]
             current = pair[0]
@@ -212,4 +352,4 @@ class MCTS():
             reversed_actions_to_leaf.append(pair[1])
 
         reversed_actions_to_leaf.reverse()
-        return reversed_actions_to_leaf
\ No newline at end of file
+        return reversed_actions_to_leaf
@@ -44,15 +44,28 @@ class DeepCube(nn.Module):
         action_output = self.policy_net(x)
         return value, action_output
 
+    def compile_forward(self, mode=None):
+        """
+        Compile forward pass with torch.compile
+        Parameters and state dict keys are unchanged, but model can't be pickled to other processes after compile
+        Args:
+            mode: torch.compile mode, eg. 'reduce-overhead'
+        """
+        self.forward = torch.compile(self.forward, mode=mode)
+
     def get_action(self, x, pre_action=None):
         """
         Return action corresponding input states
         Args:
-            x: Torch tensor of size [state_dim[0], state_dim[1]]
+            x: Torch tensor of size [state_dim[0], state_dim[1]] or [batch_size, state_dim[0], state_dim[1]]
             pre_action(int): last action to avoid its counter action (만약 pre_action이 None이면 기존과 동일, 안 넣어도 됨)
+                             only used for single state
         Returns:
-            action: Integer of action
+            action: Integer of action, list of actions of size [batch_size] if x is batch of states
         """
+        if x.dim() == 3: # batch of states, greedy action of each state
+            _, action_output = self.forward(x)
+            return action_output.argmax(dim=-1).tolist()
         if x.dim() == 2: # batch size가 없으면
             x = x.unsqueeze(dim=0)
         _, action_output = self.forward(x)
@@ -68,24 +81,40 @@ class DeepCube(nn.Module):
         else:
             invalid_action = pre_action+1
 
-        if invalid_action == action_output.sort(descending=True)[1][0][0]:
-            action = action_output.sort(descending=True)[1][0][1].item() # 최선의 action이 counter일 때 차선의 action
+        best_action, second_action = action_output[0].topk(2).indices.tolist()
+        if invalid_action == best_action:
+            action = second_action # 최선의 action이 counter일 때 차선의 action
         else:
-            action = action_output.sort(descending=True)[1][0][0].item() # 최선의 action
+            action = best_action # 최선의 action
  
         return action
 
     def predict(self, x):
         """
-        Return action and value corresponding input states
+        Return value and policy corresponding input state
+        Args:
+            x: input state of size [state_dim[0], state_dim[1]], numpy array
+        Returns:
+            value : float of state value
+            policy : contiguous float32 numpy array of policy vector    size:(action_dim,)
+        """
+        x = torch.as_tensor(x, dtype=torch.float32)
+        value, policy = self.forward(x)
+        policy = nn.functional.softmax(policy, dim=-1)
+
+        return value.item(), policy.detach().cpu().numpy()[0]
+
+    def predict_batch(self, x):
+        """
+        Return values and policies corresponding batch of input states
         Args:
-            x: input state of size [state_dim[0], state_dim[1]], tensor
+            x: input states of size [batch_size, state_dim[0], state_dim[1]], numpy array
         Returns:
-            value : integer of value  size:(action_dim,)
-            action : policy vector    size:(1,)
+            value : float32 numpy array of values    size:(batch_size,)
+            policy : contiguous float32 numpy array of policy vectors    size:(batch_size, action_dim)
         """
-        x = torch.tensor(x).float().detach()
+        x = torch.as_tensor(x, dtype=torch.float32)
         value, policy = self.forward(x)
         policy = nn.functional.softmax(policy, dim=-1)
 
-        return value.numpy()[0], policy.numpy()[0]
\ No newline at end of file
+        return value.detach().cpu().numpy()[:, 0], policy.detach().cpu().numpy()
\ No newline at end of file
@@ -1,3 +1,4 @@
+import math
 import argparse
 import matplotlib.patches as mpatches
 
@@ -137,19 +138,23 @@ def trial(model, env, cfg, scramble_count, seed = None, mask=False, mcts_=False)
                 action_list.append(action)
             next_state, _, done, _ = env.step(action)
         else:
-            for _ in range(numMCTSSim):
+            for _ in range(math.ceil(numMCTSSim / mcts.leaf_batch_size)): # each round searches leaf_batch_size leaves
                 with torch.no_grad():
                     action = mcts.train(state, env) # if solved, action is sequence of action(list type) else None
                 if action is not None:
                     done = True
+                    action_list = action_list + action
                     break
                 else:
                     done = False
+            if not done: # move to most visited next state and search again from there
+                action = int(np.argmax(mcts.get_action_prob(state, temp=0)))
+                action_list.append(action)
+                next_state, _, done, _ = env.step(action)
         if done:
             solve_scramble_count = timestep
             solve_time_time = time.time() - start_time
             trial_result = 1
-            action_list = action
             break
         state = next_state
         if timestep == max_timesteps:
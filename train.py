@@ -1,8 +1,7 @@
 import os
+import copy
 import time
 import argparse
-from collections import defaultdict
-from multiprocessing.managers import BaseManager, DictProxy
 
 import yaml
 from tqdm import tqdm
@@ -39,57 +38,64 @@ def train(cfg, args):
     cube_size = cfg['env']['cube_size']
     state_dim, action_dim = get_env_config(cube_size)
     hidden_dim = cfg['model']['hidden_dim']
+    compile_model = cfg['model']['compile']
 
     ############################
     #      Train settings      #
     ############################
+    loss_history = torch.zeros(epochs+1) # loss of each epoch, index 0 is not used
+    valid_history = torch.zeros(epochs//validation_epoch+1, cfg['validation']['sample_scramble_count']) # solve percentage of each validation
     if num_processes: # Use multi process
-        BaseManager.register('defaultdict', defaultdict, DictProxy)
-        mgr = BaseManager()
-        mgr.start()
-        loss_history = mgr.defaultdict(dict)
-        valid_history = mgr.defaultdict(dict)
+        # Keep OpenMP/MKL from spawning a thread pool per worker, workers import numpy and torch after this
+        # Single process training keeps the default thread pools for its large forward/backward
+        os.environ.setdefault('OMP_NUM_THREADS', '1')
+        os.environ.setdefault('MKL_NUM_THREADS', '1')
+        loss_history.share_memory_()
+        valid_history.share_memory_()
 
         deepcube = DeepCube(state_dim, action_dim, hidden_dim).to(device)
+        start_epoch = 1
         if args.resume:
             checkpoint = torch.load(args.resume)
             start_epoch = checkpoint['epoch']+1
             deepcube.load_state_dict(checkpoint['model_state_dict'])
-            for idx in range(1, start_epoch):
-                loss_history[idx] = {'loss':[0.0]}
-            for idx in range(1, ((start_epoch-1)//validation_epoch)+1):
-                valid_history[idx*validation_epoch] = {'solve_percentage' : [0.0]*sample_scramble_count}
         deepcube.share_memory() # global model
         optimizer = optim_func(deepcube, learning_rate)
         optimizer.share_memory()
+        epoch_counter = mp.Value('i', start_epoch-1) # last global epoch
         
     else:
         env = make_env(device, cube_size)
         start_epoch = 1
 
+        deepcube = DeepCube(state_dim, action_dim, hidden_dim).to(device)
         criterion_list = loss_func()
         optimizer = optim_func(deepcube, learning_rate)
 
-        replay_buffer = ReplayBuffer(buffer_size, sample_size, per=True)
-        loss_history = defaultdict(lambda: {'loss':[]})
-        valid_history = defaultdict(lambda: {'solve_percentage':[]})
+        replay_buffer = ReplayBuffer(buffer_size, sample_size, state_dim)
 
         if args.resume:
             checkpoint = torch.load(args.resume, map_location = device)
             start_epoch = checkpoint['epoch']+1
             deepcube.load_state_dict(checkpoint['model_state_dict'])
+        if compile_model:
+            deepcube.compile_forward()
 
     ############################
     #       train model        #
     ############################
     if num_processes: # Use multi process
-        worker_epochs_list = [epochs // num_processes for _ in range(num_processes)]
-        for i in range(epochs % num_processes):
+        remaining_epochs = max(epochs - start_epoch + 1, 0) # resumed run only trains epochs after checkpoint
+        worker_epochs_list = [remaining_epochs // num_processes for _ in range(num_processes)]
+        for i in range(remaining_epochs % num_processes):
             worker_epochs_list[i] += 1
-        workers = [mp.Process(target=single_train, args=(worker_idx, worker_epochs_list[worker_idx-1], deepcube, optimizer, valid_history, loss_history, cfg))\
+        workers = [mp.Process(target=single_train, args=(worker_idx, worker_epochs_list[worker_idx-1], deepcube, optimizer, valid_history, loss_history, epoch_counter, cfg))\
                      for worker_idx in range(1, num_processes+1)]
         [w.start() for w in workers]
         [w.join() for w in workers]
+        for worker_idx, w in enumerate(workers, start=1):
+            if w.exitcode != 0:
+                raise RuntimeError(f'Train worker {worker_idx} exited with code {w.exitcode} at global epoch {epoch_counter.value}')
 
     else: # if num_processes == 0, then train with single machine
         for epoch in tqdm(range(start_epoch, epochs+1)):
@@ -97,15 +103,15 @@ def train(cfg, args):
             if (epoch-1) % sample_epoch == 0: # replay buffer에 random sample저장
                 env.get_random_samples(replay_buffer, deepcube, sample_scramble_count, sample_cube_count, temperature)
             loss = update_params(deepcube, replay_buffer, criterion_list, optimizer, batch_size, device, temperature)
-            loss_history[epoch]['loss'].append(loss)
+            loss_history[epoch] = loss
             if epoch % validation_epoch == 0:
                 validation(deepcube, env, valid_history, epoch, device, cfg)
-                plot_valid_hist(valid_history, save_file_path=progress_path, validation_epoch=validation_epoch)
+                plot_valid_hist(valid_history, epoch, save_file_path=progress_path, validation_epoch=validation_epoch)
                 save_model(deepcube, epoch, optimizer, model_path)
-                plot_progress(loss_history, save_file_path=progress_path)
+                plot_progress(loss_history, epoch, save_file_path=progress_path)
             print(f'{epoch} : Time {time.time()-a}')
 
-def single_train(worker_idx, local_epoch_max, global_deepcube, optimizer, valid_history, loss_history, cfg):
+def single_train(worker_idx, local_epoch_max, global_deepcube, optimizer, valid_history, loss_history, epoch_counter, cfg):
     """
     Function for train on single process
 
@@ -114,8 +120,9 @@ def single_train(worker_idx, local_epoch_max, global_deepcube, optimizer, valid_
         local_epoch_max: Train epoch on single process
         global_deepcube: Shared global train model
         optimizer: Torch optimizer for global deepcube parameters
-        valid_history: Dictionary for saving validation result
-        loss_history: Dictionary for saving loss history
+        valid_history: Shared tensor for saving validation result
+        loss_history: Shared tensor for saving loss history
+        epoch_counter: Shared integer of last global epoch
         cfg: config data from yaml file    
     """
     device = torch.device(f'cpu:{worker_idx}')
@@ -134,35 +141,43 @@ def single_train(worker_idx, local_epoch_max, global_deepcube, optimizer, valid_
     cube_size = cfg['env']['cube_size']
     state_dim, action_dim = get_env_config(cube_size)
     hidden_dim = cfg['model']['hidden_dim']
+    compile_model = cfg['model']['compile']
 
     global_deepcube = global_deepcube
     deepcube = DeepCube(state_dim, action_dim, hidden_dim).to(device)
     deepcube.load_state_dict(global_deepcube.state_dict())
+    if compile_model: # only local model, global model is shared with other processes
+        deepcube.compile_forward()
     env = make_env(device, cube_size)
     local_epoch = 0
 
     optimizer = optimizer
     criterion_list = loss_func()
 
-    replay_buffer = ReplayBuffer(buffer_size, sample_size)
+    replay_buffer = ReplayBuffer(buffer_size, sample_size, state_dim)
     valid_history = valid_history
     loss_history = loss_history
 
     start = time.time()
     while local_epoch < local_epoch_max:
+        with epoch_counter.get_lock(): # global epoch is claimed before training, history has rows only up to epochs
+            if epoch_counter.value >= epochs:
+                break
+            epoch_counter.value += 1
+            global_epoch = epoch_counter.value
         local_epoch += 1
         if (local_epoch-1) % sample_epoch == 0:
             env.get_random_samples(replay_buffer, global_deepcube, sample_scramble_count, sample_cube_count, temperature)
-        deepcube.load_state_dict(global_deepcube.state_dict())
+        # update_params syncs deepcube with global_deepcube after every step, no reload is needed before it
         loss = update_params(deepcube, replay_buffer, criterion_list, optimizer, batch_size, device, temperature, global_deepcube)
-        global_epoch = len(loss_history)+1
-        loss_history[global_epoch] = {'loss':[loss]}
+        loss_history[global_epoch] = loss
         print(f"Train progress : {global_epoch} / {epochs}   Loss : {loss}   Time : {(time.time()-start)//60}min {(time.time()-start)%60:.1f}sec")
         if global_epoch % validation_epoch == 0:
-            plot_progress(loss_history, save_file_path=progress_path)
+            plot_progress(loss_history, global_epoch, save_file_path=progress_path)
+            # local deepcube is a consistent snapshot of global_deepcube, which other workers keep updating
             validation(deepcube, env, valid_history, global_epoch, device, cfg)
-            plot_valid_hist(valid_history, save_file_path=progress_path, validation_epoch=validation_epoch)
-            save_model(global_deepcube, global_epoch, optimizer, model_path)
+            plot_valid_hist(valid_history, global_epoch, save_file_path=progress_path, validation_epoch=validation_epoch)
+            save_model(deepcube, global_epoch, optimizer, model_path)
 
 def validation(model, env, valid_history, epoch, device, cfg):
     """
@@ -170,7 +185,7 @@ def validation(model, env, valid_history, epoch, device, cfg):
     Args:
         model: trained DeepCube model
         env: Cube environment
-        valid_history: Dictionary to store results
+        valid_history: Tensor to store results, row epoch//validation_epoch is solve percentage of each scramble count
         epoch: Current epoch
         cfg: Which contains validation configuration
     """
@@ -180,22 +195,38 @@ def validation(model, env, valid_history, epoch, device, cfg):
     seed = [i*10 for i in range(sample_cube_count)]
     solve_percentage_list = []
     video_path = cfg['train']['video_path']
-    for scramble_count in range(1, sample_scramble_count+1):
-        solve_count = 0
-        for idx in range(1, sample_cube_count+1):
-            state, done = env.reset(seed=seed[idx-1], scramble_count=scramble_count), False
+    if device.type == 'cuda': # half precision copy, casting model in place would round trained weights
+        half_model = DeepCube(model.state_dim, model.action_dim, model.hidden_dim).to(device).half()
+        half_model.load_state_dict(model.state_dict())
+        model, dtype = half_model, torch.float16
+    else:
+        dtype = torch.float32
+    env_list = [copy.deepcopy(env) for _ in range(sample_cube_count)] # cubes are solved in lockstep
+    # states are staged in page-locked host memory so host to device copy doesn't block
+    state_buffer = torch.empty((sample_cube_count, *model.state_dim), dtype=dtype, pin_memory=device.type=='cuda')
+    with torch.inference_mode():
+        for scramble_count in range(1, sample_scramble_count+1):
+            solve_count = 0
+            state_list = [cube_env.reset(seed=seed[idx], scramble_count=scramble_count) for idx, cube_env in enumerate(env_list)]
+            active_idx_list = list(range(sample_cube_count)) # indices of cubes not solved yet
             for timestep in range(1, max_timesteps+1):
-                with torch.no_grad():
-                    state_tensor = torch.tensor(state).float().to(device).detach()
-                    action = model.get_action(state_tensor)
-                next_state, reward, done, info = env.step(action)
-                if done:
-                    solve_count += 1
+                state_batch = state_buffer[:len(active_idx_list)]
+                state_batch.copy_(torch.from_numpy(np.array([state_list[idx] for idx in active_idx_list])))
+                state_tensor = state_batch.to(device, non_blocking=True)
+                action_list = model.get_action(state_tensor)
+                next_active_idx_list = []
+                for idx, action in zip(active_idx_list, action_list):
+                    state_list[idx], reward, done, info = env_list[idx].step(action)
+                    if done:
+                        solve_count += 1
+                    else:
+                        next_active_idx_list.append(idx)
+                active_idx_list = next_active_idx_list
+                if not active_idx_list:
                     break
-                state = next_state
-        solve_percentage = (solve_count/sample_cube_count) * 100
-        solve_percentage_list.append(solve_percentage)
-    valid_history[epoch] = {'solve_percentage':solve_percentage_list}
+            solve_percentage = (solve_count/sample_cube_count) * 100
+            solve_percentage_list.append(solve_percentage)
+    valid_history[epoch // cfg['train']['validation_epoch']] = torch.tensor(solve_percentage_list)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -205,4 +236,6 @@ if __name__ == "__main__":
 
     with open(args.config) as f:
         cfg = yaml.safe_load(f)
+    if 'forkserver' in mp.get_all_start_methods(): # not available on Windows
+        mp.set_start_method('forkserver', force=True)
     train(cfg, args)
\ No newline at end of file
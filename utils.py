@@ -1,11 +1,11 @@
 import math
-from collections import deque, Counter
+from collections import Counter
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset
 import matplotlib.pyplot as plt
 
 def loss_func():
@@ -113,21 +113,17 @@ def scheduler_func(optimizer):
     scheduler = optim.lr_scheduler.CyclicLR(optimizer, base_lr=0.0001, max_lr=0.005, step_size_up=200, step_size_down=400, mode='triangular', cycle_momentum=False)
     return scheduler
 
-def plot_progress(loss_history, save_file_path='./train_progress'):
+def plot_progress(loss_history, epoch, save_file_path='./train_progress'):
     """
     plot train progress, x-axis: epoch, y-axis: loss
     
     Args:
-        loss_history: Dictionary which contains loss
+        loss_history: Tensor which contains loss of each epoch
+        epoch: Current epoch
         save_file_path: Path for saving progress graph
     """
-    epoch_list = []
-    loss_list = []
-    for epoch, value in loss_history.items():
-        epoch_list.append(epoch)
-        loss_list.append(value['loss'])
-    epoch_list = np.array(epoch_list)
-    loss_list = np.array(loss_list)
+    epoch_list = np.arange(1, epoch+1)
+    loss_list = loss_history[1:epoch+1].numpy()
     plt.plot(epoch_list, loss_list)
     plt.title('Train Progress')
     plt.xlabel('Epoch')
@@ -136,21 +132,23 @@ def plot_progress(loss_history, save_file_path='./train_progress'):
     # plt.show()
     plt.close()
 
-def plot_valid_hist(valid_history, save_file_path='./train_progress', validation_epoch=10):
+def plot_valid_hist(valid_history, epoch, save_file_path='./train_progress', validation_epoch=10):
     """
     plot validation results, x-axis: scramble distance, y-axis: percentage solved
     
     Args:
-        valid_history: Dictionary which contains solved percentage for each scramble distance
+        valid_history: Tensor which contains solved percentage for each scramble distance,
+                       row n is result of validation at epoch n*validation_epoch
+        epoch: Current epoch
         save_file_path: Path for saving progress graph
         validation_epoch
     """
-    max_scramble_count = len(valid_history[validation_epoch]['solve_percentage'])
-    plot_epoch_list = np.unique(np.linspace(1, len(valid_history)+0.001, num=5, dtype=int))*validation_epoch
+    max_scramble_count = valid_history.size(1)
+    plot_validation_list = np.unique(np.linspace(1, epoch//validation_epoch+0.001, num=5, dtype=int))
     scramble_count_list = np.arange(1, max_scramble_count+1)
-    for epoch in plot_epoch_list:
-        solve_percentage_list = np.array(valid_history[epoch]['solve_percentage'])
-        plt.plot(scramble_count_list, solve_percentage_list, label=str(epoch))
+    for validation_idx in plot_validation_list:
+        solve_percentage_list = valid_history[validation_idx].numpy()
+        plt.plot(scramble_count_list, solve_percentage_list, label=str(validation_idx*validation_epoch))
     plt.title('Solve percentage')
     plt.xlabel('Scramble count')
     plt.ylabel('Solve percentage')
@@ -201,18 +199,25 @@ def save_model(model, epoch, optimizer, model_path):
         }, f'{model_path}/model_{epoch}.pt')
 
 class ReplayBuffer(Dataset):
-    def __init__(self, buf_size, sample_size):
+    def __init__(self, buf_size, sample_size, state_dim):
         """
-        Make replay buffer of deque structure which stores data samples
+        Make ring replay buffer of preallocated numpy arrays which stores data samples
         
         Args:
-            buf_size: deque max size
+            buf_size: Max number of samples
+            sample_size: Number of samples used for an update
+            state_dim: List of [number of cublets, possible locations]
         """
         self.buf_size = buf_size
         self.sample_size = sample_size
-        self.memory = deque(maxlen=self.buf_size)
-        self.error_memory = deque(maxlen=self.buf_size) # Deque of saving error
+        self.states = np.zeros((buf_size, *state_dim), dtype=np.uint8) # one hot states
+        self.target_values = np.zeros(buf_size, dtype=np.float32)
+        self.target_policies = np.zeros(buf_size, dtype=np.int64)
+        self.scramble_counts = np.zeros(buf_size, dtype=np.int64)
+        self.errors = np.zeros(buf_size, dtype=np.float64)
         # error means difference between target value and predicted value
+        self.next_idx = 0 # index where next sample is written, oldest sample is overwritten when full
+        self.num_samples = 0
         self.prioritized_idx = None
 
     def __len__(self):
@@ -227,47 +232,64 @@ class ReplayBuffer(Dataset):
         """
         Get samples the sample corresponding to the index
         Args:
-            idx: index of sample you want to get
+            idx: index or numpy array of indices of samples you want to get
         Returns:
             state_tensor: Torch tensor of state of shape [state_dim]
             target_value_tensor: Torch tensor of target value of shape [1]
             target_policy_tensor: Torch tensor of target value of shape [action_dim]
             scramble_count_tensor: Torch tensor of scamble count of shape [1]
+            idx_tensor: Torch tensor of index of samples in memory
+            (each with leading batch dimension if idx is array)
         """
         memory_idx = self.prioritized_idx[idx]
-        state_tensor = torch.tensor(self.memory[memory_idx]['state'])
-        target_value_tensor = torch.tensor(self.memory[memory_idx]['target_value'])
-        target_policy_tensor = torch.tensor(self.memory[memory_idx]['target_policy'])
-        scramble_count_tensor = torch.tensor(self.memory[memory_idx]['scramble_count'])
-        idx_tensor = torch.tensor(memory_idx)
+        state_tensor = torch.as_tensor(self.states[memory_idx])
+        target_value_tensor = torch.as_tensor(self.target_values[memory_idx])
+        target_policy_tensor = torch.as_tensor(self.target_policies[memory_idx])
+        scramble_count_tensor = torch.as_tensor(self.scramble_counts[memory_idx])
+        idx_tensor = torch.as_tensor(memory_idx)
         return state_tensor, target_value_tensor, target_policy_tensor, scramble_count_tensor, idx_tensor
         
     def get_prioritized_sample(self):
-        if len(self.memory) <= self.sample_size:
-            self.prioritized_idx = np.arange(len(self.memory))
+        if self.num_samples <= self.sample_size:
+            self.prioritized_idx = np.arange(self.num_samples)
         else:
-            np_error_memory = np.array(self.error_memory)
-            self.prob_memory = np_error_memory / sum(np_error_memory)
-            self.prioritized_idx = np.random.choice(np.arange(len(self.memory)), self.sample_size, replace=False, p=self.prob_memory)
+            np_error_memory = self.errors[:self.num_samples]
+            self.prob_memory = np_error_memory / np_error_memory.sum()
+            self.prioritized_idx = np.random.choice(self.num_samples, self.sample_size, replace=False, p=self.prob_memory)
 
-    def append(self, x):
+    def extend(self, states, target_values, target_policies, scramble_counts, errors):
         """
-        Append x into replay memory and save error list
+        Write batch of samples into replay memory at once
         Args:
-            x: Input
+            states: Numpy array of states of shape [batch size, *state_dim]
+            target_values: Numpy array of target values of shape [batch size]
+            target_policies: Numpy array of target policies of shape [batch size]
+            scramble_counts: Numpy array of scramble counts of shape [batch size]
+            errors: Numpy array of errors of shape [batch size]
         """
-        self.memory.append(x)
-        self.error_memory.append(x['error'])
+        num_new_samples = len(states)
+        idx = (self.next_idx + np.arange(num_new_samples)) % self.buf_size
+        if num_new_samples > self.buf_size: # only newest samples remain
+            idx, keep = idx[-self.buf_size:], slice(-self.buf_size, None)
+        else:
+            keep = slice(None)
+        self.states[idx] = states[keep]
+        self.target_values[idx] = target_values[keep]
+        self.target_policies[idx] = target_policies[keep]
+        self.scramble_counts[idx] = scramble_counts[keep]
+        self.errors[idx] = errors[keep]
+        self.next_idx = (self.next_idx + num_new_samples) % self.buf_size
+        self.num_samples = min(self.num_samples + num_new_samples, self.buf_size)
 
     def update(self, idx, error):
         """
         Update error of replay buffer
 
         Args:
-            idx: Index of replay memory you want to change
+            idx: Index or numpy array of indices of replay memory you want to change
             error: New error
         """
-        self.error_memory[idx] = error
+        self.errors[idx] = error
 
         
 def update_params(model, replay_buffer, criterion_list, optimizer, batch_size, device, temperature, global_model=None):
@@ -291,10 +313,11 @@ def update_params(model, replay_buffer, criterion_list, optimizer, batch_size, d
     value_criterion, policy_criterion = criterion_list
 
     replay_buffer.get_prioritized_sample()
-    train_dataloader = DataLoader(replay_buffer, batch_size=batch_size, shuffle=True)
     num_samples = len(replay_buffer)
+    shuffled_idx = np.random.permutation(num_samples)
     total_loss = 0.0
-    for state, target_value, target_policy, scramble_count, memory_idxs in train_dataloader:
+    for batch_start in range(0, num_samples, batch_size):
+        state, target_value, target_policy, scramble_count, memory_idxs = replay_buffer[shuffled_idx[batch_start:batch_start+batch_size]]
         state = state.to(device)
         target_value = target_value.to(device)
         target_policy = target_policy.to(device)
@@ -307,8 +330,7 @@ def update_params(model, replay_buffer, criterion_list, optimizer, batch_size, d
         loss = value_criterion(predicted_value, target_value.detach()).squeeze(dim=-1) *\
                                 reciprocal_scramble_count.squeeze(dim=-1).detach()
                         
-        for loss_idx, memory_idx in enumerate(memory_idxs):
-            replay_buffer.update(memory_idx, loss[loss_idx].item())
+        replay_buffer.update(memory_idxs.numpy(), loss.detach().cpu().numpy())
         value_loss = loss.mean()
 
         # calculate policy loss